@@ -17,8 +17,12 @@ except PackageNotFoundError:  # pragma: no cover
     __version__ = "unknown"
 
 
-from .tiler_widget import TilerWidget
-from .merger_widget import MergerWidget
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .merger_widget import MergerWidget  # pragma: no cover
+    from .tiler_widget import TilerWidget  # pragma: no cover
 
 
 __all__ = (
@@ -27,3 +31,28 @@ __all__ = (
     "MergerWidget",
 )
 
+# The widgets pull in Qt, magicgui, tiler and tifffile, so they are only
+# imported on first access (PEP 562). This keeps plugin discovery cheap.
+_SUBMODULES = ("tiler_widget", "merger_widget")
+_LAZY_ATTRIBUTES = {
+    "TilerWidget": "tiler_widget",
+    "MergerWidget": "merger_widget",
+}
+
+
+def __getattr__(name: str):
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(
+            f".{_LAZY_ATTRIBUTES[name]}", __name__
+        )
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted({*globals(), *_SUBMODULES, *_LAZY_ATTRIBUTES})
+
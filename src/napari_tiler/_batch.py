@@ -0,0 +1,643 @@
+"""This provides batch tiling readers, writers and shared memory helpers."""
+
+import logging
+import math
+import mmap
+import multiprocessing
+import pathlib
+from collections import Counter, deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import numpy as np
+
+# `tifffile`, `tiler` and `dask` are imported where they are used to keep the
+# plugin quick to import
+if TYPE_CHECKING:
+    from tiler import Tiler  # pragma: no cover
+
+logger = logging.getLogger(__name__)
+
+
+class BatchImage(NamedTuple):
+    """An image opened for batch tiling.
+
+    `data` may be any array-like (memory-mapped, dask, deferred, ...) and is
+    only read one tile at a time. `rgb` of `None` means it is guessed from
+    the shape, as napari does. `name_suffix` is appended to the file stem to
+    name the output tiles, e.g. `_c0` for the first channel.
+    """
+
+    data: Any
+    rgb: Optional[bool] = None
+    name_suffix: str = ""
+
+
+BatchReader = Callable[[pathlib.Path], List[BatchImage]]
+
+
+class DeferredArray:
+    """An image that can only be decoded as a whole, decoded on demand.
+
+    `read(out)` decodes straight into `out`, e.g. a shared memory block, so
+    the image is never held in private memory as well.
+    """
+
+    def __init__(self, shape: Sequence[int], dtype, read: Callable) -> None:
+        """Init the DeferredArray class."""
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self._read = read
+
+    def read(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Decode the image, into `out` if given."""
+        return self._read(out=out)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        """Decode the image into a new array."""
+        data = self.read()
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+
+def read_tiff(path: pathlib.Path) -> List[BatchImage]:
+    """Open a TIFF file, memory-mapped if possible."""
+    import tifffile
+
+    try:
+        data = tifffile.memmap(path, mode="r")
+    except ValueError:
+        # compressed or tiled data cannot be memory-mapped
+        with tifffile.TiffFile(path) as tif:
+            series = tif.series[0]
+            shape, dtype = series.shape, series.dtype
+        data = DeferredArray(shape, dtype, partial(tifffile.imread, path))
+    return [BatchImage(data)]
+
+
+def read_npy(path: pathlib.Path) -> List[BatchImage]:
+    """Open a `.npy` file memory-mapped."""
+    return [BatchImage(np.load(path, mmap_mode="r"))]
+
+
+def read_with_napari(path: pathlib.Path) -> List[BatchImage]:
+    """Open any file supported by an installed napari reader plugin.
+
+    Multiscale data is tiled at full resolution and images with a channel
+    axis are split into one image per channel.
+    """
+    from napari.plugins.io import read_data_with_plugins
+
+    layer_data, _ = read_data_with_plugins([str(path)], stack=False)
+    images = []
+    for i, layer_datum in enumerate(layer_data or []):
+        data = layer_datum[0]
+        meta = layer_datum[1] if len(layer_datum) > 1 else {}
+        layer_type = layer_datum[2] if len(layer_datum) > 2 else "image"
+        if layer_type not in ("image", "labels"):
+            continue
+        if meta.get("multiscale") or isinstance(data, list):
+            data = data[0]
+        name_suffix = "" if len(layer_data) == 1 else f"_{i}"
+        channel_axis = meta.get("channel_axis")
+        if channel_axis is None:
+            images.append(BatchImage(data, meta.get("rgb"), name_suffix))
+            continue
+        channel_axis %= data.ndim
+        for c in range(data.shape[channel_axis]):
+            index = (slice(None),) * channel_axis + (c,)
+            images.append(
+                BatchImage(data[index], False, f"{name_suffix}_c{c}")
+            )
+    return images
+
+
+READERS: Dict[str, BatchReader] = {
+    ".tif": read_tiff,
+    ".tiff": read_tiff,
+    ".npy": read_npy,
+}
+
+
+def register_reader(suffix: str, reader: BatchReader) -> None:
+    """Use `reader` to open batch input files ending with `suffix`."""
+    READERS[suffix.lower()] = reader
+
+
+def get_reader(path: pathlib.Path) -> BatchReader:
+    """Return the reader for `path`, falling back to napari plugins."""
+    return READERS.get(path.suffix.lower(), read_with_napari)
+
+
+def can_read(path: pathlib.Path) -> bool:
+    """Return whether a batch reader or a napari reader plugin opens `path`."""
+    if path.suffix.lower() in READERS:
+        return True
+    from npe2 import PluginManager
+
+    readers = PluginManager.instance().iter_compatible_readers([str(path)])
+    return next(iter(readers), None) is not None
+
+
+def find_images(
+    input_dir: pathlib.Path,
+    pattern: str = "*",
+    recursive: bool = False,
+    exclude: Optional[pathlib.Path] = None,
+) -> List[pathlib.Path]:
+    """Return the readable batch input paths in `input_dir`.
+
+    Paths must match `pattern`. Hidden files, paths inside `exclude` (e.g. an
+    output folder within the input folder) and files no reader can open are
+    left out. Zarr stores are directories and are returned as a single path.
+    """
+    paths = input_dir.rglob(pattern) if recursive else input_dir.glob(pattern)
+    images = []
+    for path in paths:
+        relative_parts = path.relative_to(input_dir).parts
+        if any(part.startswith(".") for part in relative_parts):
+            continue
+        if any(part.lower().endswith(".zarr") for part in relative_parts[:-1]):
+            continue
+        if exclude is not None and exclude in path.parents:
+            continue
+        if not path.is_file() and path.suffix.lower() != ".zarr":
+            continue
+        if can_read(path):
+            images.append(path)
+    return sorted(images)
+
+
+def output_stems(
+    paths: Sequence[pathlib.Path],
+    input_dir: pathlib.Path,
+    output_dir: pathlib.Path,
+) -> Dict[pathlib.Path, pathlib.Path]:
+    """Return where the tiles of each input path are written.
+
+    The input folder structure is mirrored in `output_dir`. When several
+    inputs in a folder share a stem (`a.tif`, `a.npy`), all but the first
+    get their source suffix appended so they do not overwrite each other.
+    """
+    stems = {}
+    used = set()
+    for path in paths:
+        # mirror the input folder structure for recursive batches
+        stem = output_dir / path.parent.relative_to(input_dir) / path.stem
+        if stem in used:
+            source_suffix = path.suffix.lstrip(".").lower()
+            stem = stem.with_name(f"{stem.name}_{source_suffix}")
+        used.add(stem)
+        stems[path] = stem
+    return stems
+
+
+def guess_rgb(shape: Sequence[int]) -> bool:
+    """Guess whether the last axis holds RGB(A) channels, as napari does."""
+    return len(shape) > 2 and shape[-1] in (3, 4)
+
+
+def tiler_kwargs(
+    data_shape: Sequence[int],
+    rgb: Optional[bool],
+    tile_shape: np.ndarray,
+    overlap,
+    mode: str,
+    constant_value: float,
+) -> Dict:
+    """Return the `Tiler` arguments to cut an image into `tile_shape` tiles.
+
+    `tile_shape` is in napari order and may have fewer dimensions than the
+    image: leading image dimensions are then kept whole.
+    """
+    data_shape = np.array(data_shape)
+    if rgb is None:
+        rgb = guess_rgb(data_shape)
+
+    # Validate and adjust tile shape
+    channel_dimension = None
+    if rgb:
+        # RGB(A) is the last dimension, could be 3 or 4
+        tile_shape = np.append(tile_shape, data_shape[-1])
+        channel_dimension = len(data_shape) - 1
+
+    elif len(data_shape) >= len(tile_shape):
+        for i in range(len(data_shape) - len(tile_shape)):
+            tile_shape = np.insert(tile_shape, i, data_shape[i])
+
+    else:
+        raise ValueError(
+            "Tiles must have the same or fewer dimensions than the "
+            f"image. Tiles have {len(tile_shape)} dimenions and the "
+            f"image has {len(data_shape)} dimensions."
+        )
+
+    return {
+        "data_shape": data_shape,
+        "tile_shape": tile_shape,
+        "overlap": overlap,
+        "channel_dimension": channel_dimension,
+        "mode": mode,
+        "constant_value": constant_value,
+    }
+
+
+def write_tiles(
+    tiler: "Tiler", data, dtype, stem: pathlib.Path, suffix: str = ".tif"
+) -> None:
+    """Write every tile of `data` to its own TIFF file next to `stem`.
+
+    Tiles are extracted and written one at a time, so the tiles stack is
+    never held in memory.
+    """
+    import tifffile
+
+    length = len(tiler)
+    nr_of_zeros = int(math.ceil(math.log10(length))) if length > 1 else 1
+    for tile_id in range(length):
+        tile = np.asarray(tiler.get_tile(data, tile_id), dtype=dtype)
+        path = stem.with_name(
+            f"{stem.name}_{str(tile_id).zfill(nr_of_zeros)}{suffix}"
+        )
+        tifffile.imwrite(path, tile)
+
+
+def write_image_tiles(
+    batch_image: BatchImage,
+    tile_parameters: Dict,
+    stem: pathlib.Path,
+    suffix: str = ".tif",
+) -> None:
+    """Tile one opened image with `tile_parameters` and write its tiles."""
+    from tiler import Tiler
+
+    data = batch_image.data
+    if isinstance(data, DeferredArray):
+        data = data.read()
+    kwargs = tiler_kwargs(data.shape, batch_image.rgb, **tile_parameters)
+    stem = stem.with_name(stem.name + batch_image.name_suffix)
+    write_tiles(Tiler(**kwargs), data, data.dtype, stem, suffix)
+
+
+class ArrayDescriptor(NamedTuple):
+    """Describes an array that another process can attach to without copying.
+
+    The data lives either in a named shared memory block or in a
+    memory-mapped file. If `decode` is set, the block is still empty and the
+    attaching process fills it with `decode(out=...)`.
+    """
+
+    shape: Tuple[int, ...]
+    dtype: str
+    shm_name: Optional[str] = None
+    filename: Optional[str] = None
+    offset: int = 0
+    order: Literal["C", "F"] = "C"
+    decode: Optional[Callable] = None
+
+
+def share_array(data) -> Tuple[ArrayDescriptor, Optional[SharedMemory]]:
+    """Make `data` available to other processes.
+
+    Memory-mapped files are shared by reference. Anything else is placed in
+    a new shared memory block, which the caller must release with
+    `release_shared` when all attached processes are done. Deferred images
+    are not decoded here: the block is left for the attaching process to
+    decode into, so decoding runs in parallel in the worker processes.
+    """
+    import dask.array as da
+
+    dtype = np.dtype(data.dtype)
+    # views into a memory map report the offset of the whole map, so only
+    # share the map itself
+    if isinstance(data, np.memmap) and isinstance(data.base, mmap.mmap):
+        order: Literal["C", "F"] = (
+            "F" if data.flags.f_contiguous and data.ndim > 1 else "C"
+        )
+        descriptor = ArrayDescriptor(
+            tuple(data.shape),
+            dtype.str,
+            filename=str(data.filename),
+            offset=data.offset,
+            order=order,
+        )
+        return descriptor, None
+
+    shape = tuple(data.shape)
+    size = max(int(np.prod(shape)), 1) * dtype.itemsize
+    shm = SharedMemory(create=True, size=size)
+    if isinstance(data, DeferredArray):
+        descriptor = ArrayDescriptor(
+            shape, dtype.str, shm_name=shm.name, decode=data.read
+        )
+        return descriptor, shm
+    try:
+        shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        if isinstance(data, da.Array):
+            # compute chunk by chunk straight into shared memory
+            da.store(data, shared, lock=False)
+        else:
+            # lazily paged data, e.g. a view into a memory map
+            np.copyto(shared, data)
+        del shared
+    except BaseException:
+        release_shared(shm)
+        raise
+    return ArrayDescriptor(shape, dtype.str, shm_name=shm.name), shm
+
+
+def attach_array(
+    descriptor: ArrayDescriptor, writeable: bool = False
+) -> Tuple[np.ndarray, Optional[SharedMemory]]:
+    """Return a view of a shared array and its memory block.
+
+    Views are read-only unless `writeable`, which only applies to shared
+    memory blocks.
+    """
+    if descriptor.filename is not None:
+        data = np.memmap(
+            descriptor.filename,
+            dtype=descriptor.dtype,
+            mode="r",
+            offset=descriptor.offset,
+            shape=descriptor.shape,
+            order=descriptor.order,
+        )
+        return data, None
+    shm = SharedMemory(name=descriptor.shm_name)
+    data = np.ndarray(descriptor.shape, dtype=descriptor.dtype, buffer=shm.buf)
+    data.flags.writeable = writeable
+    return data, shm
+
+
+def release_shared(shm: Optional[SharedMemory]) -> None:
+    """Free a shared memory block created by `share_array`."""
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def write_shared_tiles(
+    descriptor: ArrayDescriptor,
+    kwargs: Dict,
+    dtype,
+    stem: pathlib.Path,
+    suffix: str = ".tif",
+) -> None:
+    """Attach to a shared image and write its tiles.
+
+    This is the entry point for batch worker processes: only the descriptor
+    and tiler parameters are pickled, never the image or its tiles.
+    """
+    from tiler import Tiler
+
+    data, shm = attach_array(descriptor, descriptor.decode is not None)
+    try:
+        if descriptor.decode is not None:
+            descriptor.decode(out=data)
+        write_tiles(Tiler(**kwargs), data, dtype, stem, suffix)
+    finally:
+        # the view must be gone before the block can be closed
+        del data
+        if shm is not None:
+            shm.close()
+
+
+def write_file_tiles(
+    path: pathlib.Path,
+    tile_parameters: Dict,
+    stem: pathlib.Path,
+    suffix: str = ".tif",
+) -> List[str]:
+    """Open `path` and write the tiles of each of its images.
+
+    This is the entry point for batch worker processes for files opened by
+    napari reader plugins. These may decode eagerly, so the file is read in
+    the worker process rather than decoded and then copied to shared memory.
+    Returns the errors of images that could not be tiled.
+    """
+    errors = []
+    for batch_image in get_reader(path)(path):
+        try:
+            write_image_tiles(batch_image, tile_parameters, stem, suffix)
+        except Exception as e:
+            errors.append(f"{stem.name}{batch_image.name_suffix}: {e}")
+    return errors
+
+
+class BatchPool:
+    """Runs batch tiling jobs in worker processes.
+
+    Jobs are grouped by a key (the input path). The generator methods yield
+    once for every key whose jobs have all finished, so they can drive a
+    progress bar. At most `processes` jobs, and so shared memory blocks, are
+    pending at a time.
+    """
+
+    def __init__(self, processes: int) -> None:
+        """Init the BatchPool class."""
+        self.processes = processes
+        # forking a process running Qt threads is unsafe
+        self._executor = ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._pending: Deque[
+            Tuple[Any, Future, Optional[SharedMemory]]
+        ] = deque()
+        self._outstanding: "Counter[Any]" = Counter()
+        self._closed: Set[Any] = set()
+
+    def submit_image(
+        self,
+        key,
+        batch_image: BatchImage,
+        tile_parameters: Dict,
+        stem: pathlib.Path,
+        suffix: str = ".tif",
+    ) -> Iterator[None]:
+        """Share an opened image and tile it in a worker process."""
+        yield from self._wait(self.processes - 1)
+        data = batch_image.data
+        kwargs = tiler_kwargs(data.shape, batch_image.rgb, **tile_parameters)
+        stem = stem.with_name(stem.name + batch_image.name_suffix)
+        descriptor, shm = share_array(data)
+        self._submit(
+            key,
+            shm,
+            write_shared_tiles,
+            descriptor,
+            kwargs,
+            data.dtype,
+            stem,
+            suffix,
+        )
+
+    def submit_file(
+        self,
+        key,
+        path: pathlib.Path,
+        tile_parameters: Dict,
+        stem: pathlib.Path,
+        suffix: str = ".tif",
+    ) -> Iterator[None]:
+        """Open and tile a file in a worker process."""
+        yield from self._wait(self.processes - 1)
+        self._submit(
+            key, None, write_file_tiles, path, tile_parameters, stem, suffix
+        )
+
+    def close(self, key) -> Iterator[None]:
+        """Mark that all jobs for `key` were submitted."""
+        if self._outstanding[key] == 0:
+            del self._outstanding[key]
+            yield
+        else:
+            self._closed.add(key)
+
+    def join(self) -> Iterator[None]:
+        """Wait for all jobs, then stop the worker processes."""
+        yield from self._wait(0)
+        self._executor.shutdown()
+
+    def cancel(self) -> None:
+        """Cancel queued jobs and free shared memory once running ones end.
+
+        This blocks until running jobs are done, so call it from a thread.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        while self._pending:
+            _, future, shm = self._pending.popleft()
+            try:
+                future.result()
+            except (CancelledError, Exception):
+                pass
+            finally:
+                release_shared(shm)
+
+    def _submit(self, key, shm: Optional[SharedMemory], fn, *args) -> None:
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            # e.g. `BrokenProcessPool` after a worker crashed
+            release_shared(shm)
+            raise
+        self._pending.append((key, future, shm))
+        self._outstanding[key] += 1
+
+    def _wait(self, max_pending: int) -> Iterator[None]:
+        while len(self._pending) > max_pending:
+            key, future, shm = self._pending.popleft()
+            try:
+                for error in future.result() or []:
+                    logger.warning("Batch tiling failed: %s", error)
+            except Exception as e:
+                logger.warning("Batch tiling failed for %s: %s", key, e)
+            finally:
+                release_shared(shm)
+            self._outstanding[key] -= 1
+            if self._outstanding[key] == 0 and key in self._closed:
+                self._closed.discard(key)
+                del self._outstanding[key]
+                yield
+
+
+def batch_tile(
+    paths: Sequence[pathlib.Path],
+    input_dir: pathlib.Path,
+    output_dir: pathlib.Path,
+    tile_parameters: Dict,
+    pool: Optional[BatchPool] = None,
+) -> Iterator[None]:
+    """Write the tiles of every image in `paths` to `output_dir`.
+
+    Yields once for every input path whose tiles are written, so that a
+    thread worker can report progress and stop early. Images that cannot be
+    read or tiled are logged and skipped. With a `pool`, images are tiled in
+    its worker processes.
+    """
+    stems = output_stems(paths, input_dir, output_dir)
+    try:
+        for path in paths:
+            stem = stems[path]
+            stem.parent.mkdir(parents=True, exist_ok=True)
+            suffix = ".tiff" if path.suffix.lower() == ".tiff" else ".tif"
+            if pool is not None and path.suffix.lower() not in READERS:
+                yield from pool.submit_file(
+                    path, path, tile_parameters, stem, suffix
+                )
+                yield from pool.close(path)
+                continue
+            try:
+                images = get_reader(path)(path)
+            except Exception as e:
+                logger.warning("Skipping %s: %s", path, e)
+                images = []
+            for batch_image in images:
+                try:
+                    if pool is None:
+                        write_image_tiles(
+                            batch_image, tile_parameters, stem, suffix
+                        )
+                    else:
+                        yield from pool.submit_image(
+                            path, batch_image, tile_parameters, stem, suffix
+                        )
+                except Exception as e:
+                    name = stem.name + batch_image.name_suffix
+                    logger.warning("Skipping %s: %s", name, e)
+            if pool is None:
+                yield
+            else:
+                yield from pool.close(path)
+        if pool is not None:
+            yield from pool.join()
+    except Exception:
+        # e.g. a crashed worker process, free what is still shared
+        if pool is not None:
+            pool.cancel()
+        raise
+
+
+def batch_tile_folder(
+    input_dir: pathlib.Path,
+    output_dir: pathlib.Path,
+    pattern: str,
+    recursive: bool,
+    tile_parameters: Dict,
+    pool: Optional[BatchPool] = None,
+) -> Iterator[Optional[int]]:
+    """Find the images in `input_dir` and write their tiles to `output_dir`.
+
+    Searching a large folder tree can take long, so it is done here, on the
+    thread worker. Yields the number of images found first, then once for
+    every image written, as `batch_tile` does.
+    """
+    try:
+        paths = find_images(
+            input_dir,
+            pattern,
+            recursive,
+            exclude=None if output_dir == input_dir else output_dir,
+        )
+    except Exception:
+        if pool is not None:
+            pool.cancel()
+        raise
+    yield len(paths)
+    yield from batch_tile(paths, input_dir, output_dir, tile_parameters, pool)
@@ -0,0 +1,238 @@
+import pathlib
+
+import numpy as np
+import pytest
+import tifffile
+
+import napari_tiler
+from napari_tiler._batch import (
+    DeferredArray,
+    attach_array,
+    find_images,
+    get_reader,
+    read_npy,
+    read_tiff,
+    release_shared,
+    share_array,
+    tiler_kwargs,
+    write_shared_tiles,
+)
+
+
+def test_find_images(tmp_path):
+    """Test that batch inputs are filtered by pattern and recursion."""
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "out").mkdir()
+    (tmp_path / "store.zarr").mkdir()
+    (tmp_path / "store.zarr" / ".zarray").touch()
+    names = [
+        "a.tif",
+        "b.npy",
+        "notes.txt",
+        ".DS_Store",
+        "sub/c.tif",
+        "out/a_0.tif",
+    ]
+    for name in names:
+        (tmp_path / name).touch()
+
+    found = [p.name for p in find_images(tmp_path)]
+    assert "a.tif" in found and "b.npy" in found
+    assert "notes.txt" not in found
+    assert ".DS_Store" not in found
+    assert ".zarray" not in found
+    assert [p.name for p in find_images(tmp_path, "*.tif")] == ["a.tif"]
+    assert [p.name for p in find_images(tmp_path, "*.tif", True)] == [
+        "a.tif",
+        "a_0.tif",
+        "c.tif",
+    ]
+    assert [
+        p.name
+        for p in find_images(tmp_path, "*.tif", True, exclude=tmp_path / "out")
+    ] == ["a.tif", "c.tif"]
+
+    # only stores inside the input folder are skipped
+    nested_dir = tmp_path / "data.zarr" / "images"
+    nested_dir.mkdir(parents=True)
+    (nested_dir / "d.tif").touch()
+    assert [p.name for p in find_images(nested_dir)] == ["d.tif"]
+
+
+def test_readers_are_lazy(tmp_path):
+    """Test that uncompressed TIFF and `.npy` inputs are memory-mapped."""
+    data = np.random.random((64, 64)).astype(np.float32)
+    np.save(tmp_path / "image.npy", data)
+    tifffile.imwrite(tmp_path / "image.tif", data)
+
+    assert get_reader(tmp_path / "image.npy") is read_npy
+    assert get_reader(tmp_path / "image.TIF") is read_tiff
+    for path in [tmp_path / "image.npy", tmp_path / "image.tif"]:
+        (batch_image,) = get_reader(path)(path)
+        assert batch_image.name_suffix == ""
+        assert isinstance(batch_image.data, np.memmap)
+        np.testing.assert_array_equal(batch_image.data, data)
+
+
+def test_tiler_widget_batch(make_napari_viewer, qtbot, tmp_path):
+    """Test that batch tiling writes one file per tile for each input."""
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    (input_dir / "sub").mkdir(parents=True)
+    output_dir.mkdir()
+    data = np.random.random((256, 256)).astype(np.float32)
+    np.save(input_dir / "a.npy", data)
+    tifffile.imwrite(input_dir / "sub" / "b.tif", data)
+
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    widget.overlap_dsb.setValue(0)
+    widget.input_folder_input.setText(str(input_dir))
+    widget.output_folder_input.setText(str(output_dir))
+    widget.recursive_chkb.setChecked(True)
+
+    worker = widget._run_batch()
+    with qtbot.waitSignal(worker.finished, timeout=30000):
+        pass
+
+    assert worker.pbar.total == 2
+    assert len(list(output_dir.glob("a_*.tif"))) == 4
+    tiles = sorted((output_dir / "sub").glob("b_*.tif"))
+    assert len(tiles) == 4
+    np.testing.assert_array_equal(tifffile.imread(tiles[0]), data[:128, :128])
+
+
+def test_tiler_widget_batch_skips_failing_images(
+    make_napari_viewer, qtbot, tmp_path
+):
+    """Test that an image that cannot be tiled does not stop the batch."""
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    # `a.npy` is 2D and cannot be cut into 3D tiles
+    np.save(input_dir / "a.npy", np.zeros((256, 256), dtype=np.uint8))
+    np.save(input_dir / "b.npy", np.zeros((4, 256, 256), dtype=np.uint8))
+    tifffile.imwrite(input_dir / "b.tif", np.zeros((4, 256, 256), np.uint8))
+
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    widget.overlap_dsb.setValue(0)
+    widget.input_folder_input.setText(str(input_dir))
+    widget.output_folder_input.setText(str(output_dir))
+    dims_layout = widget.tile_dims_container.layout()
+    dims_layout.itemAt(0).widget()._add_below()
+    dims_layout.itemAt(1).widget()._dim_sb.setValue(4)
+
+    worker = widget._run_batch()
+    with qtbot.waitSignal(worker.finished, timeout=30000):
+        pass
+
+    assert not list(output_dir.glob("a_*"))
+    # `b.npy` and `b.tif` do not overwrite each other
+    assert len(list(output_dir.glob("b_?.tif"))) == 4
+    assert len(list(output_dir.glob("b_tif_?.tif"))) == 4
+
+
+def test_share_array(tmp_path):
+    """Test that shared arrays are attached without copying the data."""
+    data = np.random.random((32, 48))
+    descriptor, shm = share_array(data)
+    assert shm is not None
+    shared, attached_shm = attach_array(descriptor)
+    np.testing.assert_array_equal(shared, data)
+    assert not shared.flags.writeable
+    del shared
+    attached_shm.close()
+    release_shared(shm)
+
+    np.save(tmp_path / "image.npy", np.asfortranarray(data))
+    memmap = np.load(tmp_path / "image.npy", mmap_mode="r")
+    descriptor, shm = share_array(memmap)
+    assert shm is None
+    assert descriptor.filename is not None
+    shared, _ = attach_array(descriptor)
+    np.testing.assert_array_equal(shared, data)
+
+    # views of a memory map are copied into shared memory instead
+    descriptor, shm = share_array(memmap[1:])
+    assert shm is not None
+    release_shared(shm)
+
+    # compressed TIFFs are decoded by the worker, into shared memory
+    tifffile.imwrite(tmp_path / "image.tif", data, compression="zlib")
+    (batch_image,) = read_tiff(tmp_path / "image.tif")
+    assert isinstance(batch_image.data, DeferredArray)
+    descriptor, shm = share_array(batch_image.data)
+    assert descriptor.decode is not None
+    kwargs = tiler_kwargs(data.shape, False, np.array([16, 16]), 0, "drop", 0)
+    write_shared_tiles(descriptor, kwargs, data.dtype, tmp_path / "tile")
+    release_shared(shm)
+    assert len(list(tmp_path.glob("tile_*.tif"))) == 6
+    np.testing.assert_array_equal(
+        tifffile.imread(tmp_path / "tile_0.tif"), data[:16, :16]
+    )
+
+
+def test_tiler_widget_batch_processes(make_napari_viewer, qtbot, tmp_path):
+    """Test that batch tiling with worker processes writes all tiles."""
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    data = np.random.random((256, 256)).astype(np.float32)
+    for name in ["a", "b", "c"]:
+        tifffile.imwrite(input_dir / f"{name}.tif", data, compression="zlib")
+
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    widget.overlap_dsb.setValue(0)
+    widget.input_folder_input.setText(str(input_dir))
+    widget.output_folder_input.setText(str(output_dir))
+    widget.processes_sb.setValue(2)
+
+    worker = widget._run_batch()
+    with qtbot.waitSignal(worker.finished, timeout=60000):
+        pass
+
+    tiles = sorted(output_dir.glob("*.tif"))
+    assert len(tiles) == 12
+    np.testing.assert_array_equal(tifffile.imread(tiles[-1]), data[128:, 128:])
+
+
+SHM_DIR = pathlib.Path("/dev/shm")
+
+
+def _shared_blocks() -> set:
+    return set(SHM_DIR.glob("psm_*"))
+
+
+@pytest.mark.skipif(not SHM_DIR.is_dir(), reason="requires /dev/shm")
+def test_tiler_widget_batch_cancel(make_napari_viewer, qtbot, tmp_path):
+    """Test that cancelling a batch frees the shared memory of its jobs."""
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    data = np.random.random((512, 512)).astype(np.float32)
+    for i in range(20):
+        tifffile.imwrite(input_dir / f"{i:02}.tif", data, compression="zlib")
+
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    widget.overlap_dsb.setValue(0)
+    xy_dims = widget.tile_dims_container.layout().itemAt(0).widget()
+    xy_dims._x_dim_sb.setValue(16)
+    xy_dims._y_dim_sb.setValue(16)
+    widget.input_folder_input.setText(str(input_dir))
+    widget.output_folder_input.setText(str(output_dir))
+    widget.processes_sb.setValue(2)
+    blocks_before = _shared_blocks()
+
+    worker = widget._run_batch()
+    with qtbot.waitSignals([worker.aborted, worker.finished], timeout=60000):
+        qtbot.waitUntil(lambda: bool(_shared_blocks() - blocks_before))
+        widget._cancel()
+
+    qtbot.waitUntil(lambda: _shared_blocks() <= blocks_before, timeout=60000)
+    assert len(list(output_dir.glob("*.tif"))) < 20 * 32 * 32
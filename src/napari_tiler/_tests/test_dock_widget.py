@@ -1,8 +1,12 @@
+import math
+
+import napari
 import numpy as np
 import pytest
 
 import napari_tiler
 from napari_tiler import TilerWidget, MergerWidget
+from napari_tiler.tiler_widget import DEFAULTS
 
 sample_image_data = [
     (np.random.random((512, 512)), False),  # 2d
@@ -12,6 +16,12 @@ sample_image_data = [
 ]
 
 
+def _wait_for_worker(qtbot, worker):
+    """Block until a thread worker has finished."""
+    with qtbot.waitSignal(worker.finished, timeout=30000):
+        pass
+
+
 def test_load_widgets(make_napari_viewer):
     """Test that napari loads the widget through the plugin manager."""
     viewer = make_napari_viewer()
@@ -40,7 +50,9 @@ def test_tiler_widget_no_image(make_napari_viewer):
 
 
 @pytest.mark.parametrize("image_data,rgb", sample_image_data)
-def test_tiler_widget_default_parameters(make_napari_viewer, image_data, rgb):
+def test_tiler_widget_default_parameters(
+    make_napari_viewer, qtbot, image_data, rgb
+):
     """Test basic functionality of the tiler widget."""
     viewer = make_napari_viewer()
     widget = napari_tiler.tiler_widget.TilerWidget(viewer)
@@ -48,10 +60,31 @@ def test_tiler_widget_default_parameters(make_napari_viewer, image_data, rgb):
 
     viewer.add_image(image_data, rgb=rgb)
     num_layers = len(viewer.layers)
-    widget._run()
+    _wait_for_worker(qtbot, widget._run())
     assert len(viewer.layers) == num_layers + 1
 
 
+def test_tiler_widget_cancel(make_napari_viewer, qtbot):
+    """Test that cancelling a run does not add a tiles layer."""
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    viewer.window.add_dock_widget(widget)
+
+    viewer.add_image(np.random.random((2048, 2048)).astype(np.float32))
+    dims_field = widget.tile_dims_container.layout().itemAt(0).widget()
+    dims_field._x_dim_sb.setValue(8)
+    dims_field._y_dim_sb.setValue(8)
+    num_layers = len(viewer.layers)
+
+    worker = widget._run()
+    assert not widget.run_btn.isEnabled()
+    with qtbot.waitSignals([worker.aborted, worker.finished], timeout=30000):
+        widget._cancel()
+    assert len(viewer.layers) == num_layers
+    assert widget.run_btn.isEnabled()
+    assert widget._worker is None
+
+
 @pytest.mark.parametrize("image_data,rgb", sample_image_data)
 def test_tiler_widget_generate_preview(make_napari_viewer, image_data, rgb):
     """Test basic functionality of the tiler widget."""
@@ -124,14 +157,14 @@ def test_tiler_widget_add_remove_tile_dimensions(make_napari_viewer):
 
 
 @pytest.mark.parametrize("image_data,rgb", sample_image_data)
-def test_tiler_widget(image_data, rgb, make_napari_viewer):
+def test_tiler_widget(image_data, rgb, make_napari_viewer, qtbot):
     """Test that tiler widget raises an error for too many tile dimensions."""
     viewer = make_napari_viewer()
     widget = napari_tiler.tiler_widget.TilerWidget(viewer)
     viewer.window.add_dock_widget(widget)
 
     viewer.add_image(image_data, rgb=rgb)
-    widget._run()
+    _wait_for_worker(qtbot, widget._run())
 
     # test raises value error when tile dims > image dims
     with pytest.raises(ValueError):
@@ -142,7 +175,9 @@ def test_tiler_widget(image_data, rgb, make_napari_viewer):
 
 
 @pytest.mark.parametrize("image_data,rgb", sample_image_data)
-def test_merger_widget_default_parameters(image_data, rgb, make_napari_viewer):
+def test_merger_widget_default_parameters(
+    image_data, rgb, make_napari_viewer, qtbot
+):
     """Test that merger widget output matches pre-tiled image."""
     viewer = make_napari_viewer()
     tiler_widget = napari_tiler.tiler_widget.TilerWidget(viewer)
@@ -151,15 +186,152 @@ def test_merger_widget_default_parameters(image_data, rgb, make_napari_viewer):
     viewer.window.add_dock_widget(merger_widget)
 
     viewer.add_image(image_data, rgb=rgb)
-    tiler_widget._run()
+    _wait_for_worker(qtbot, tiler_widget._run())
     merger_widget.image_select.native.setCurrentIndex(1)
 
     # merger creates a new layer
     num_layers = len(viewer.layers)
-    merger_widget._run()
+    _wait_for_worker(qtbot, merger_widget._run())
     assert len(viewer.layers) == num_layers + 1
 
     # merged layer is same as original
     merged_image_data = viewer.layers[-1].data
     np.testing.assert_almost_equal(image_data, merged_image_data)
 
+
+def test_tiler_widget_memory_estimate(make_napari_viewer):
+    """Test the memory estimate shown next to the preview shape."""
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    viewer.window.add_dock_widget(widget)
+    image = viewer.add_image(np.zeros((512, 512), dtype=np.uint16))
+
+    widget.overlap_dsb.setValue(0)
+    widget._initialize_tiler()
+    estimate = napari_tiler.tiler_widget.estimate_memory(widget._tiler, image)
+    assert estimate.num_tiles == 16
+    assert estimate.output_bytes == 16 * 128 * 128 * 2
+    assert estimate.peak_bytes > estimate.output_bytes
+
+    # shown without enabling the preview
+    assert not widget.preview_chkb.isChecked()
+    assert "16 tiles" in widget.memory_estimate.text()
+    assert "tiler preview" not in viewer.layers
+
+
+def test_tiler_widget_memory_estimate_updates(make_napari_viewer):
+    """Test that the estimate follows the mode and extra tile dimensions."""
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    viewer.window.add_dock_widget(widget)
+    image = viewer.add_image(np.zeros((10, 500, 500), dtype=np.uint8))
+    widget.reset_choices()
+    widget.image_select.value = image
+    widget.overlap_dsb.setValue(0)
+    assert "16 tiles" in widget.memory_estimate.text()
+
+    widget.mode_select.setCurrentText("drop")
+    assert "9 tiles" in widget.memory_estimate.text()
+
+    dims_layout = widget.tile_dims_container.layout()
+    dims_layout.itemAt(0).widget()._add_below()
+    # a Z tile size of 5 splits the 10 slices in two
+    assert "18 tiles" in widget.memory_estimate.text()
+    dims_layout.itemAt(1).widget()._dim_sb.setValue(10)
+    assert "9 tiles" in widget.memory_estimate.text()
+
+
+def test_tiler_widget_lazy_over_memory_budget(make_napari_viewer, qtbot):
+    """Test that tiles are generated lazily when over the memory budget."""
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    viewer.window.add_dock_widget(widget)
+    image_data = np.random.random((5, 512, 512))
+    viewer.add_image(image_data)
+
+    _wait_for_worker(qtbot, widget._run())
+    eager_tiles = viewer.layers[-1].data
+
+    widget.memory_fraction_dsb.setValue(0)
+    assert widget._run() is None
+    lazy_tiles = viewer.layers[-1].data
+    assert not isinstance(lazy_tiles, np.ndarray)
+    # several tiles per dask chunk
+    num_chunks = math.ceil(len(widget._tiler) / DEFAULTS.chunk_size)
+    assert lazy_tiles.numblocks[0] == num_chunks
+    np.testing.assert_array_equal(eager_tiles, np.asarray(lazy_tiles))
+
+
+def test_multi_layer_tiling_and_merging(make_napari_viewer, qtbot):
+    """Test that image and labels layers are tiled and merged together."""
+    viewer = make_napari_viewer()
+    tiler_widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    merger_widget = napari_tiler.merger_widget.MergerWidget(viewer)
+    viewer.window.add_dock_widget(tiler_widget)
+    viewer.window.add_dock_widget(merger_widget)
+
+    image_data = np.random.random((512, 512))
+    labels_data = np.random.randint(0, 10, (512, 512))
+    image = viewer.add_image(image_data)
+    labels = viewer.add_labels(labels_data)
+    tiler_widget.reset_choices()
+    tiler_widget.image_select.value = image
+    tiler_widget.layers_select.value = [labels]
+    _wait_for_worker(qtbot, tiler_widget._run())
+
+    image_tiles, labels_tiles = viewer.layers[-2:]
+    assert isinstance(labels_tiles, napari.layers.Labels)
+    assert image_tiles.data.shape == labels_tiles.data.shape
+    assert napari_tiler.merger_widget._same_geometry(
+        image_tiles.metadata, labels_tiles.metadata
+    )
+
+    merger_widget.reset_choices()
+    merger_widget.image_select.value = image_tiles
+    merger_widget.layers_select.value = [labels_tiles]
+    _wait_for_worker(qtbot, merger_widget._run())
+
+    merged_image, merged_labels = viewer.layers[-2:]
+    assert isinstance(merged_labels, napari.layers.Labels)
+    np.testing.assert_almost_equal(merged_image.data, image_data)
+    np.testing.assert_array_equal(merged_labels.data, labels_data)
+
+
+def test_multi_layer_tiling_shape_mismatch(make_napari_viewer):
+    """Test that extra layers must match the image shape."""
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    viewer.window.add_dock_widget(widget)
+
+    image = viewer.add_image(np.random.random((512, 512)))
+    labels = viewer.add_labels(np.zeros((256, 256), dtype=int))
+    widget.reset_choices()
+    widget.image_select.value = image
+    widget.layers_select.value = [labels]
+    # shown in the memory estimate, not raised from the signal callback
+    assert "differs from the image shape" in widget.memory_estimate.text()
+    with pytest.raises(ValueError):
+        widget._run()
+
+
+def test_labels_padded_with_background(make_napari_viewer, qtbot):
+    """Test that labels are padded with 0 instead of the constant value."""
+    viewer = make_napari_viewer()
+    widget = napari_tiler.tiler_widget.TilerWidget(viewer)
+    viewer.window.add_dock_widget(widget)
+
+    image = viewer.add_image(np.zeros((200, 200), dtype=np.uint8))
+    labels = viewer.add_labels(np.ones((200, 200), dtype=np.uint8))
+    widget.reset_choices()
+    widget.image_select.value = image
+    widget.layers_select.value = [labels]
+    widget.overlap_dsb.setValue(0)
+    widget.mode_select.setCurrentText("constant")
+    widget.constant_dsb.setValue(5)
+    _wait_for_worker(qtbot, widget._run())
+
+    image_tiles, labels_tiles = viewer.layers[-2:]
+    # the last tile covers [128:256, 128:256] and is mostly padding
+    assert image_tiles.data[-1, -1, -1] == 5
+    assert labels_tiles.data[-1, -1, -1] == 0
+    assert labels_tiles.metadata["constant_value"] == 5
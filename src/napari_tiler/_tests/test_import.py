@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import napari_tiler
+
+HEAVY_MODULES = ["dask", "magicgui", "napari", "qtpy", "tifffile", "tiler"]
+
+# far below the cost of the widgets, but timings depend on the machine, so
+# the check only runs when `NAPARI_TILER_BENCHMARK` is set
+MAX_IMPORT_TIME_US = 200_000
+
+
+def _import_in_subprocess(code: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_import_does_not_load_widgets():
+    """Test that importing the plugin does not import heavy dependencies."""
+    result = _import_in_subprocess(
+        "import sys, napari_tiler; "
+        f"print([m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    )
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.skipif(
+    not os.environ.get("NAPARI_TILER_BENCHMARK"),
+    reason="timing benchmark, set NAPARI_TILER_BENCHMARK to run",
+)
+def test_import_time():
+    """Test that importing the plugin stays fast."""
+    result = _import_in_subprocess("import napari_tiler")
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "napari_tiler":
+            assert int(fields[1]) < MAX_IMPORT_TIME_US
+            break
+    else:
+        raise AssertionError("napari_tiler not found in -X importtime output")
+
+
+def test_lazy_attributes():
+    """Test that widgets and submodules are available on first access."""
+    assert set(napari_tiler.__all__) <= set(dir(napari_tiler))
+    assert {"tiler_widget", "merger_widget"} <= set(dir(napari_tiler))
+    assert napari_tiler.TilerWidget is napari_tiler.tiler_widget.TilerWidget
+    assert napari_tiler.MergerWidget.__name__ == "MergerWidget"
@@ -1,11 +1,17 @@
 """This provides the widgets to make or merge tiles."""
-from typing import TYPE_CHECKING, Optional
+import math
+from functools import partial
+from typing import TYPE_CHECKING, Dict, Generator, List, Optional, Sequence
 
-from magicgui.widgets import create_widget
+import numpy as np
+from magicgui.widgets import Select, create_widget
+from napari.layers import Image, Labels
+from napari.qt.threading import create_worker
 from qtpy.QtCore import QEvent
 from qtpy.QtWidgets import (
     QComboBox,
     QFormLayout,
+    QHBoxLayout,
     QLabel,
     QPushButton,
     QVBoxLayout,
@@ -15,6 +21,10 @@ from tiler import Merger, Tiler
 
 if TYPE_CHECKING:
     import napari  # pragma: no cover
+    from napari.qt.threading import GeneratorWorker  # pragma: no cover
+
+# number of tiles merged between progress updates
+CHUNK_SIZE = 16
 
 
 class MergerWidget(QWidget):
@@ -33,6 +43,8 @@ class MergerWidget(QWidget):
         self.image_select = create_widget(
             annotation="napari.layers.Image", label="image_layer"
         )
+        # extra tiles layers made with the same geometry to merge
+        self.layers_select = Select(choices=self._get_layer_choices)
         # mode selection
         self.mode_select = QComboBox()
         self.mode_select.addItems(Merger.SUPPORTED_WINDOWS)
@@ -40,18 +52,49 @@ class MergerWidget(QWidget):
         form_layout = QFormLayout()
         form_layout.setFieldGrowthPolicy(QFormLayout.AllNonFixedFieldsGrow)
         form_layout.addRow("Image", self.image_select.native)
+        form_layout.addRow("Also Merge", self.layers_select.native)
         form_layout.addRow("Mode", self.mode_select)
         self.layout().addLayout(form_layout)
-        # `run` button
+        # `run` and `cancel` buttons
+        self._worker: Optional["GeneratorWorker"] = None
+        self._mergers: Optional[List[Merger]] = None
+        run_layout = QHBoxLayout()
         self.run_btn = QPushButton("Run")
         self.run_btn.clicked.connect(self._run)
-        self.layout().addWidget(self.run_btn)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.clicked.connect(self._cancel)
+        run_layout.addWidget(self.run_btn)
+        run_layout.addWidget(self.cancel_btn)
+        self.layout().addLayout(run_layout)
+
+    def _get_layer_choices(self, widget=None) -> List:
+        return [
+            (layer.name, layer)
+            for layer in self.viewer.layers
+            if isinstance(layer, (Image, Labels))
+            and "data_shape" in layer.metadata
+        ]
 
-    def _initialize_merger(self) -> None:
+    def _selected_layers(self) -> List:
+        """Return the image layer followed by the extra layers to merge."""
         image = self.image_select.value
-        metadata = image.metadata
-        print(metadata)
-        # is_rgb = image.rgb
+        layers = [image]
+        for layer in self.layers_select.value:
+            if layer is image:
+                continue
+            if layer.data.shape != image.data.shape or not _same_geometry(
+                layer.metadata, image.metadata
+            ):
+                raise ValueError(
+                    f"Layer '{layer.name}' was not tiled with the same "
+                    f"parameters as '{image.name}'."
+                )
+            layers.append(layer)
+        return layers
+
+    def _initialize_mergers(self, layers: List) -> List[Merger]:
+        metadata = layers[0].metadata
         tiler = Tiler(
             data_shape=metadata["data_shape"],
             tile_shape=metadata["tile_shape"],
@@ -60,28 +103,75 @@ class MergerWidget(QWidget):
             mode=metadata["mode"],
             constant_value=metadata["constant_value"],
         )
-        self._merger = Merger(
-            tiler=tiler, window=self.mode_select.currentText()
-        )
+        window = self.mode_select.currentText()
+        # averaging label ids with a tapered window would change them
+        self._mergers = [
+            Merger(
+                tiler=tiler,
+                window="boxcar" if isinstance(layer, Labels) else window,
+            )
+            for layer in layers
+        ]
+        return self._mergers
 
-    def _run(self) -> None:
+    def _run(self) -> "GeneratorWorker":
+        """Merge the selected tiles layers in a background thread.
+
+        All layers share one tiler and are merged in a single pass over the
+        tile ids.
+        """
         # TODO copy over other image data like transform, colormap, ...
-        self._initialize_merger()
-        merger = self._merger
-        image = self.image_select.value
-        metadata = image.metadata
-        is_rgb = image.rgb
-        num_tiles = image.data.shape[0]
-        for i in range(num_tiles):
-            merger.add(i, image.data[i, ...])
-        merged = merger.merge(dtype=image.dtype)
-        self.viewer.add_image(
-            merged,
-            name=f"{image.name} merged",
-            rgb=is_rgb,
-            metadata=metadata,
-            colormap=image.colormap,
+        layers = self._selected_layers()
+        mergers = self._initialize_mergers(layers)
+        worker = create_worker(
+            merge_tiles,
+            mergers,
+            [layer.data for layer in layers],
+            [layer.dtype for layer in layers],
+            _progress={
+                "total": math.ceil(layers[0].data.shape[0] / CHUNK_SIZE),
+                "desc": f"Merging {layers[0].name}...",
+            },
         )
+        worker.returned.connect(partial(self._add_merged_layers, layers))
+        self._start_worker(worker)
+        return worker
+
+    def _add_merged_layers(self, layers: List, merged_images: List) -> None:
+        for layer, merged in zip(layers, merged_images):
+            if isinstance(layer, Labels):
+                self.viewer.add_labels(
+                    merged,
+                    name=f"{layer.name} merged",
+                    metadata=dict(layer.metadata),
+                )
+            else:
+                self.viewer.add_image(
+                    merged,
+                    name=f"{layer.name} merged",
+                    rgb=layer.rgb,
+                    metadata=dict(layer.metadata),
+                    colormap=layer.colormap,
+                )
+
+    def _start_worker(self, worker: "GeneratorWorker") -> None:
+        self._worker = worker
+        worker.finished.connect(self._on_worker_finished)
+        self.run_btn.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+        worker.start()
+
+    def _cancel(self) -> None:
+        """Stop the running worker after the current chunk of tiles."""
+        if self._worker is not None:
+            self._worker.quit()
+
+    def _on_worker_finished(self) -> None:
+        # drop the worker and mergers so their buffers can be freed
+        self._worker = None
+        self._mergers = None
+        self.run_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
 
     # thanks to https://github.com/BiAPoL/napari-clusters-plotter/blob/main/napari_clusters_plotter/_measure.py  # noqa
     def showEvent(self, event: QEvent) -> None:  # noqa: D102
@@ -91,6 +181,49 @@ class MergerWidget(QWidget):
     def reset_choices(self, event: Optional[QEvent] = None) -> None:
         """Repopulate image list."""
         self.image_select.reset_choices(event)
+        self.layers_select.reset_choices(event)
+
+
+def _same_geometry(metadata: Dict, other: Dict) -> bool:
+    """Return whether two tiles layers were made with the same parameters."""
+    keys = (
+        "data_shape",
+        "tile_shape",
+        "overlap",
+        "channel_dimension",
+        "mode",
+        "constant_value",
+    )
+    return all(
+        key in other and np.array_equal(metadata[key], other[key])
+        for key in keys
+    )
+
+
+def merge_tiles(
+    mergers: Sequence[Merger],
+    tiles_stacks: Sequence,
+    dtypes: Sequence,
+    chunk_size: int = CHUNK_SIZE,
+) -> Generator[None, None, List[np.ndarray]]:
+    """Add the tiles of each stack to its merger and return merged images.
+
+    All stacks are read in the same pass over the tile ids, `chunk_size`
+    tiles at a time, which matches the chunks of lazy tiles stacks. Yields
+    after every chunk so that a thread worker can report progress and stop
+    early.
+    """
+    num_tiles = tiles_stacks[0].shape[0]
+    for start in range(0, num_tiles, chunk_size):
+        stop = min(start + chunk_size, num_tiles)
+        for merger, tiles in zip(mergers, tiles_stacks):
+            block = np.asarray(tiles[start:stop])
+            for tile_id, tile in enumerate(block, start):
+                merger.add(tile_id, tile)
+        yield
+    return [
+        merger.merge(dtype=dtype) for merger, dtype in zip(mergers, dtypes)
+    ]
 
 
 # if __name__ == "__main__":
@@ -2,13 +2,26 @@
 
 import logging
 import math
+import os
 import pathlib
+import uuid
+import dask.array as da
 import numpy as np
-import tifffile
-from typing import TYPE_CHECKING, Dict, Optional
+import psutil
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
 from napari.qt.threading import create_worker
-from napari.layers import Image
-from magicgui.widgets import create_widget
+from napari.layers import Image, Labels
+from napari.utils.notifications import show_warning
+from magicgui.widgets import Select, create_widget
 from qtpy.QtCore import QEvent, Signal
 from qtpy.QtWidgets import (
     QAbstractSpinBox,
@@ -25,10 +38,14 @@ from qtpy.QtWidgets import (
     QWidget,
     QFileDialog,
 )
+
 from tiler import Tiler
 
+from ._batch import BatchPool, batch_tile_folder, tiler_kwargs
+
 if TYPE_CHECKING:
     import napari  # pragma: no cover
+    from napari.qt.threading import GeneratorWorker  # pragma: no cover
 
 
 logger = logging.getLogger(__name__)
@@ -40,6 +57,9 @@ class DEFAULTS:
     tile_size = 128
     extra_dim_size = 5
     overlap = 0.1
+    chunk_size = 16
+    memory_fraction = 0.5
+    batch_pattern = "*"
 
 
 class TilerWidget(QWidget):
@@ -60,6 +80,11 @@ class TilerWidget(QWidget):
         self.image_select = create_widget(
             annotation="napari.layers.Image", label="image_layer"
         )
+        self.image_select.changed.connect(self._parameters_changed)
+
+        # extra layers of the same shape to tile with the same geometry
+        self.layers_select = Select(choices=self._get_layer_choices)
+        self.layers_select.changed.connect(self._parameters_changed)
 
         # tile dimensions input
         self.tile_dims_container = TileDimensions()
@@ -83,6 +108,7 @@ class TilerWidget(QWidget):
         available_modes.remove("irregular")
         self.mode_select.addItems(available_modes)
         self.mode_select.currentIndexChanged.connect(self._on_mode_changed)
+        self.mode_select.currentIndexChanged.connect(self._parameters_changed)
 
         # `constant` value input
         self.constant_dsb = QDoubleSpinBox(minimum=0, maximum=255)
@@ -93,24 +119,42 @@ class TilerWidget(QWidget):
         self.preview_chkb = QCheckBox()
         self.preview_chkb.stateChanged.connect(self._parameters_changed)
         self.preview_shape = QLabel()
+        self.memory_estimate = QLabel()
         self.preview_layout.addWidget(self.preview_chkb)
         self.preview_layout.addWidget(self.preview_shape)
+        self.preview_layout.addWidget(self.memory_estimate)
+
+        # fraction of available memory a run may use before tiles are
+        # generated lazily instead
+        self.memory_fraction_dsb = QDoubleSpinBox(minimum=0, maximum=1)
+        self.memory_fraction_dsb.setSingleStep(0.05)
+        self.memory_fraction_dsb.setValue(DEFAULTS.memory_fraction)
+        self.memory_fraction_dsb.valueChanged.connect(self._parameters_changed)
 
         # add form to main layout
         form_layout = QFormLayout()
         form_layout.setFieldGrowthPolicy(QFormLayout.AllNonFixedFieldsGrow)
         form_layout.addRow("Image", self.image_select.native)
+        form_layout.addRow("Also Tile", self.layers_select.native)
         form_layout.addRow("Tile Size", self.tile_dims_container)
         form_layout.addRow("Overlap", self.overlap_dsb)
         form_layout.addRow("Mode", self.mode_select)
         form_layout.addRow(self.constant_lbl, self.constant_dsb)
         # form_layout.addRow(self.constant_dsb_container)
+        form_layout.addRow("Memory Budget", self.memory_fraction_dsb)
         form_layout.addRow("Preview", self.preview_layout)
         self.layout().addLayout(form_layout)
-        # `run` button
+        # `run` and `cancel` buttons
+        self._worker: Optional["GeneratorWorker"] = None
+        run_layout = QHBoxLayout()
         self.run_btn = QPushButton("Run")
         self.run_btn.clicked.connect(self._run)
-        self.layout().addWidget(self.run_btn)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.clicked.connect(self._cancel)
+        run_layout.addWidget(self.run_btn)
+        run_layout.addWidget(self.cancel_btn)
+        self.layout().addLayout(run_layout)
 
         # Batch Processing
         self.default_input_folder = str(pathlib.Path.home())
@@ -132,10 +176,17 @@ class TilerWidget(QWidget):
         output_folder_layout.addWidget(browse_output_button)
         batch_form_layout.addRow("Input Folder", input_folder_layout)
         batch_form_layout.addRow("Output Folder", output_folder_layout)
+        self.pattern_input = QLineEdit()
+        self.pattern_input.setText(DEFAULTS.batch_pattern)
+        self.recursive_chkb = QCheckBox()
+        batch_form_layout.addRow("Pattern", self.pattern_input)
+        batch_form_layout.addRow("Recursive", self.recursive_chkb)
+        self.processes_sb = QSpinBox(minimum=1, maximum=os.cpu_count() or 1)
+        batch_form_layout.addRow("Processes", self.processes_sb)
         self.layout().addLayout(batch_form_layout)
-        run_batch_btn = QPushButton("Run Batch")
-        run_batch_btn.clicked.connect(self._run_batch)
-        self.layout().addWidget(run_batch_btn)
+        self.run_batch_btn = QPushButton("Run Batch")
+        self.run_batch_btn.clicked.connect(self._run_batch)
+        self.layout().addWidget(self.run_batch_btn)
 
         # initial show or hide constant input spinbox
         self._on_mode_changed()
@@ -163,61 +214,146 @@ class TilerWidget(QWidget):
         return self._do_initialize_tiler(image)
 
     def _do_initialize_tiler(self, image) -> Dict:
-        data_shape = np.array(image.data.shape)
-        tile_shape = self.tile_shape
-        mode = self.mode_select.currentText()
-        constant = self.constant_dsb.value()
+        kwargs = self._tiler_kwargs(image)
+        self._tiler = Tiler(**kwargs)
+        return kwargs
+
+    def _tiler_kwargs(self, image) -> Dict:
+        return tiler_kwargs(
+            image.data.shape, image.rgb, **self._tile_parameters()
+        )
+
+    def _tile_parameters(self) -> Dict:
+        """Return the tiling parameters that do not depend on the image."""
         overlap = self.overlap_dsb.value()
         if overlap == int(overlap):
             overlap = int(overlap)
-
-        # Validate and adjust tile shape
-        channel_dimension = None
-        is_rgb = image.rgb
-        if is_rgb:
-            # RGB(A) is the last dimension, could be 3 or 4
-            tile_shape = np.append(tile_shape, data_shape[-1])
-            channel_dimension = len(data_shape) - 1
-
-        elif len(data_shape) >= len(tile_shape):
-            for i in range(len(data_shape) - len(tile_shape)):
-                tile_shape = np.insert(tile_shape, i, data_shape[i])
-
-        else:
-            raise ValueError(
-                "Tiles must have the same or fewer dimensions than the "
-                f"image. Tiles have {len(tile_shape)} dimenions and the "
-                f"image has {len(data_shape)} dimensions."
-            )
-
-        kwargs = {
-            "data_shape": data_shape,
-            "tile_shape": tile_shape,
+        return {
+            "tile_shape": self.tile_shape,
             "overlap": overlap,
-            "channel_dimension": channel_dimension,
-            "mode": mode,
-            "constant_value": constant,
+            "mode": self.mode_select.currentText(),
+            "constant_value": self.constant_dsb.value(),
         }
 
-        self._tiler = Tiler(**kwargs)
-
-        return kwargs
+    def _get_layer_choices(self, widget=None) -> List:
+        return [
+            (layer.name, layer)
+            for layer in self.viewer.layers
+            if isinstance(layer, (Image, Labels))
+        ]
 
-    def _run(self) -> None:
-        metadata = self._initialize_tiler()
-        tiler = self._tiler
+    def _selected_layers(self) -> List:
+        """Return the image layer followed by the extra layers to tile."""
         image = self.image_select.value
-        is_rgb = image.rgb
+        layers = [image]
+        for layer in self.layers_select.value:
+            if layer is image:
+                continue
+            if layer.data.shape != image.data.shape:
+                raise ValueError(
+                    f"Layer '{layer.name}' has shape {layer.data.shape}, "
+                    f"which differs from the image shape {image.data.shape}."
+                )
+            layers.append(layer)
+        return layers
+
+    def _run(self) -> Optional["GeneratorWorker"]:
+        """Tile the selected layers in a background thread.
+
+        The tiler is initialized once on the calling thread so that invalid
+        parameters raise immediately, and all layers are tiled in a single
+        pass over the tile ids. The tiles layers are added once the worker
+        returns. If the run would exceed the memory budget, lazy tiles
+        layers are added right away and no worker is started.
+        """
+        metadata = self._initialize_tiler()
+        layers = self._selected_layers()
+        tilers = self._layer_tilers(layers, metadata)
+        arrays = [layer.data for layer in layers]
+        dtypes = [layer.dtype for layer in layers]
+        estimate = estimate_memory(self._tiler, *layers)
+        if self._exceeds_memory_budget(estimate):
+            logger.info("Memory budget exceeded, tiling lazily")
+            tiles_stacks = [
+                make_lazy_tiles(tiler, data, dtype)
+                for tiler, data, dtype in zip(tilers, arrays, dtypes)
+            ]
+            self._add_tiles_layers(layers, metadata, tiles_stacks)
+            return None
+
+        worker = create_worker(
+            make_tiles,
+            tilers,
+            arrays,
+            dtypes,
+            _progress={
+                "total": math.ceil(len(self._tiler) / DEFAULTS.chunk_size),
+                "desc": f"Tiling {layers[0].name}...",
+            },
+        )
+        worker.returned.connect(
+            partial(self._add_tiles_layers, layers, metadata)
+        )
+        self._start_worker(worker)
+        return worker
+
+    def _layer_tilers(self, layers: List, kwargs: Dict) -> List[Tiler]:
+        """Return the tiler for each layer.
+
+        Labels are padded with the background label 0 in constant mode, as
+        the constant value would add a label that is not in the data.
+        """
+        if kwargs["mode"] != "constant" or kwargs["constant_value"] == 0:
+            return [self._tiler] * len(layers)
+        labels_tiler = Tiler(**{**kwargs, "constant_value": 0})
+        return [
+            labels_tiler if isinstance(layer, Labels) else self._tiler
+            for layer in layers
+        ]
+
+    def _exceeds_memory_budget(self, estimate: "MemoryEstimate") -> bool:
+        available = psutil.virtual_memory().available
+        budget = self.memory_fraction_dsb.value() * available
+        return estimate.peak_bytes > budget
+
+    def _add_tiles_layers(
+        self, layers: List, metadata: Dict, tiles_stacks: List
+    ) -> None:
+        for layer, tiles_stack in zip(layers, tiles_stacks):
+            if isinstance(layer, Labels):
+                self.viewer.add_labels(
+                    tiles_stack,
+                    name=f"{layer.name} tiles",
+                    metadata=dict(metadata),
+                )
+            else:
+                self.viewer.add_image(
+                    tiles_stack,
+                    name=f"{layer.name} tiles",
+                    rgb=layer.rgb,
+                    metadata=dict(metadata),
+                    colormap=layer.colormap,
+                )
+
+    def _start_worker(self, worker: "GeneratorWorker") -> None:
+        self._worker = worker
+        worker.finished.connect(self._on_worker_finished)
+        self.run_btn.setEnabled(False)
+        self.run_batch_btn.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+        worker.start()
 
-        tiles_stack = tiler.get_all_tiles(image.data).astype(image.dtype)
+    def _cancel(self) -> None:
+        """Stop the running worker after the current chunk of tiles."""
+        if self._worker is not None:
+            self._worker.quit()
 
-        self.viewer.add_image(
-            tiles_stack,
-            name=f"{image.name} tiles",
-            rgb=is_rgb,
-            metadata=metadata,
-            colormap=image.colormap,
-        )
+    def _on_worker_finished(self) -> None:
+        # drop the worker so a partially filled tiles stack can be freed
+        self._worker = None
+        self.run_btn.setEnabled(True)
+        self.run_batch_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
 
     def _browse_input(self) -> None:
 
@@ -234,40 +370,48 @@ class TilerWidget(QWidget):
         if output_folder_from_user:
             self.output_folder_input.setText(output_folder_from_user)
 
-    def _run_batch(self) -> None:
-        input_folder = pathlib.Path(self.input_folder_input.text())
-        input_dir = pathlib.Path(input_folder)
-        files = list(input_dir.iterdir())
-        images = [item for item in files if item.is_file() and item.suffix.lower() in ['.tif', '.tiff']]
-        worker = create_worker(self._batch,
-                               _progress={'total': len(images), 'desc': 'Batch tiling images...'})
-        worker.start()
-
-    def _batch(self) -> None:
-        input_folder = pathlib.Path(self.input_folder_input.text())
-        output_folder = pathlib.Path(self.output_folder_input.text())
-        if not input_folder.exists() or not output_folder.exists():
-            print("Folder does not exist!")
-            return
-        input_dir = pathlib.Path(input_folder)
-        output_dir = pathlib.Path(output_folder)
-        for item in input_dir.iterdir():
-            if not item.is_file() or not item.suffix.lower() in ['.tif', '.tiff']:
-                continue
-            input_image = tifffile.imread(item)
-            layer = Image(input_image)
-            self._do_initialize_tiler(layer)
-            tiler = self._tiler
-            tiles_stack = tiler.get_all_tiles(layer.data).astype(layer.dtype)
-            length = tiles_stack.shape[0]
-            nr_of_zeros = int(math.ceil(math.log10(length)))
-            for counter in range(length):
-                path = output_dir.joinpath(item.stem + "_" +str(counter).zfill(nr_of_zeros) + item.suffix)
-                tifffile.imwrite(path, tiles_stack[counter-1])
-            yield
+    def _run_batch(self) -> Optional["GeneratorWorker"]:
+        input_dir = pathlib.Path(self.input_folder_input.text())
+        output_dir = pathlib.Path(self.output_folder_input.text())
+        if not input_dir.exists() or not output_dir.exists():
+            show_warning("Folder does not exist!")
+            return None
+        # read the parameters here, widgets must not be used from the worker
+        tile_parameters = self._tile_parameters()
+        processes = self.processes_sb.value()
+        pool = BatchPool(processes) if processes > 1 else None
+        # the worker finds the images and then reports how many there are,
+        # a nonzero total is needed for progress to follow the yields
+        worker = create_worker(
+            batch_tile_folder,
+            input_dir,
+            output_dir,
+            self.pattern_input.text() or DEFAULTS.batch_pattern,
+            self.recursive_chkb.isChecked(),
+            tile_parameters,
+            pool,
+            _progress={"total": 1, "desc": "Batch tiling images..."},
+        )
+        worker.yielded.connect(partial(self._on_batch_yielded, worker))
+        if pool is not None:
+            worker.aborted.connect(partial(self._on_batch_aborted, pool))
+        self._start_worker(worker)
+        return worker
+
+    def _on_batch_yielded(
+        self, worker: "GeneratorWorker", num_images: Optional[int]
+    ) -> None:
+        if num_images is not None:
+            worker.pbar.reset(total=num_images)
+
+    def _on_batch_aborted(self, pool: BatchPool) -> None:
+        # queued jobs are dropped, but running ones hold shared memory until
+        # they finish, so wait for them off the GUI thread
+        create_worker(pool.cancel).start()
 
     def _parameters_changed(self) -> None:
         # TODO wait until user has completed input, otherwise this is costly
+        self._update_memory_estimate()
         if self.preview_chkb.isChecked():
             self._initialize_tiler()
             self.preview_shape.setText(str(self._tiler.get_mosaic_shape()))
@@ -276,6 +420,27 @@ class TilerWidget(QWidget):
             self._remove_preview_layer()
             self.preview_shape.setText("")
 
+    def _update_memory_estimate(self) -> None:
+        """Show the predicted size of a run, without drawing the preview."""
+        if self.image_select.value is None:
+            self.memory_estimate.setText("")
+            return
+        try:
+            self._initialize_tiler()
+            layers = self._selected_layers()
+        except ValueError as e:
+            self.memory_estimate.setText(str(e))
+            return
+        estimate = estimate_memory(self._tiler, *layers)
+        text = (
+            f"{estimate.num_tiles} tiles, "
+            f"{format_bytes(estimate.output_bytes)} "
+            f"(peak {format_bytes(estimate.peak_bytes)})"
+        )
+        if self._exceeds_memory_budget(estimate):
+            text += ", lazy"
+        self.memory_estimate.setText(text)
+
     def _validate_overlap_value(self) -> None:
         value = self.overlap_dsb.value()
         if value >= 1:
@@ -320,6 +485,97 @@ class TilerWidget(QWidget):
     def reset_choices(self, event: Optional[QEvent] = None) -> None:
         """Repopulate image list."""
         self.image_select.reset_choices(event)
+        self.layers_select.reset_choices(event)
+
+
+class MemoryEstimate(NamedTuple):
+    """Predicted size of a tiling run."""
+
+    num_tiles: int
+    output_bytes: int
+    peak_bytes: int
+
+
+def estimate_memory(tiler: Tiler, *images) -> MemoryEstimate:
+    """Predict the memory needed to tile `images` with `tiler`.
+
+    The output is one full tiles stack per image. On top of that,
+    `Tiler.get_tile` holds a copy of the current tile and, for edge tiles in
+    padding modes, a padded copy of it. Lazily loaded image data is read one
+    tile at a time, so the source arrays themselves are not counted.
+    """
+    num_tiles = len(tiler)
+    itemsizes = [np.dtype(image.dtype).itemsize for image in images]
+    tile_size = int(np.prod(tiler.tile_shape))
+    output_bytes = num_tiles * tile_size * sum(itemsizes)
+    tile_bytes = tile_size * max(itemsizes)
+    working_bytes = tile_bytes if tiler.mode == "drop" else 2 * tile_bytes
+    peak_bytes = output_bytes + working_bytes
+    return MemoryEstimate(num_tiles, output_bytes, peak_bytes)
+
+
+def format_bytes(num_bytes: float) -> str:
+    """Return a human readable size, e.g. `1.5 GiB`."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+def make_lazy_tiles(
+    tiler: Tiler, data, dtype, chunk_size: int = DEFAULTS.chunk_size
+) -> da.Array:
+    """Return a dask tiles stack where tiles are extracted on access.
+
+    Each dask chunk holds `chunk_size` tiles, which keeps the task graph
+    small for runs with many tiles.
+    """
+    tile_shape = tuple(int(s) for s in tiler.tile_shape)
+    tile_ids = da.arange(len(tiler), chunks=chunk_size)
+
+    def _get_tiles(block: np.ndarray) -> np.ndarray:
+        tiles = np.empty((len(block), *tile_shape), dtype=dtype)
+        for i, tile_id in enumerate(block):
+            tiles[i] = tiler.get_tile(data, int(tile_id))
+        return tiles
+
+    # an explicit name skips hashing the (possibly huge) source data
+    return tile_ids.map_blocks(
+        _get_tiles,
+        name=f"tiles-{uuid.uuid4().hex}",
+        chunks=(tile_ids.chunks[0], *((s,) for s in tile_shape)),
+        new_axis=list(range(1, len(tile_shape) + 1)),
+        dtype=dtype,
+        meta=np.empty((0,) * (len(tile_shape) + 1), dtype=dtype),
+    )
+
+
+def make_tiles(
+    tilers: Sequence[Tiler],
+    arrays: Sequence,
+    dtypes: Sequence,
+    chunk_size: int = DEFAULTS.chunk_size,
+) -> Generator[None, None, List[np.ndarray]]:
+    """Extract all tiles from each of `arrays` into aligned stacks.
+
+    Each array is tiled with its own tiler; all tilers must share the same
+    geometry and may only differ in padding value. Every array is tiled in
+    the same pass over the tile ids, so co-located data is read together.
+    Yields after every `chunk_size` tiles so that a thread worker can report
+    progress and stop early. The tiles stacks are returned when done.
+    """
+    num_tiles = len(tilers[0])
+    tiles_stacks = [
+        np.empty((num_tiles, *tilers[0].tile_shape), dtype=dtype)
+        for dtype in dtypes
+    ]
+    for start in range(0, num_tiles, chunk_size):
+        for tile_id in range(start, min(start + chunk_size, num_tiles)):
+            for tiler, data, tiles_stack in zip(tilers, arrays, tiles_stacks):
+                tiles_stack[tile_id] = tiler.get_tile(data, tile_id)
+        yield
+    return tiles_stacks
 
 
 class DimensionField(QWidget):
@@ -338,13 +594,19 @@ class DimensionField(QWidget):
 
     def _remove(self) -> None:
         """Remove self from layout and delete."""
+        tile_dimensions = self.parent()
         self.setParent(None)
+        tile_dimensions.valueChanged.emit()
         del self
 
     def _add_below(self) -> None:
-        parent_layout: QVBoxLayout = self.parent().layout()
+        tile_dimensions = self.parent()
+        parent_layout: QVBoxLayout = tile_dimensions.layout()
         idx = parent_layout.indexOf(self)
-        parent_layout.insertWidget(idx + 1, ExtraDimensionField())
+        field = ExtraDimensionField()
+        field.valueChanged.connect(tile_dimensions.valueChanged)
+        parent_layout.insertWidget(idx + 1, field)
+        tile_dimensions.valueChanged.emit()
 
     def get_dims(self) -> np.ndarray:
         """Return dimension(s) from input field(s)."""